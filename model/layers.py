@@ -1,20 +1,36 @@
+import math
+
 import tensorflow as tf
 
-from model.transformer_utils import positional_encoding, scaled_dot_product_attention
+from model.transformer_utils import positional_encoding, scaled_dot_product_attention, dropout_residual_layer_norm, \
+    create_look_ahead_mask, stack_attention_weights, create_additive_mask
+
+
+class FusedDense(tf.keras.layers.Dense):
+    """Dense layer computing a rank 2 matmul followed by an explicit bias_add and activation, which are
+    fused into a single kernel. Dense uses tensordot on rank 3 inputs, which puts a reshape in between.
+    The variables are the same as Dense's, so checkpoints are interchangeable.
+    """
+    
+    def call(self, inputs):
+        x = tf.reshape(inputs, (-1, inputs.shape[-1]))  # (batch_size * seq_len, input_dim)
+        x = tf.matmul(x, self.kernel)
+        if self.use_bias:
+            x = tf.nn.bias_add(x, self.bias)
+        x = self.activation(x)
+        return tf.reshape(x, tf.concat([tf.shape(inputs)[:-1], [self.units]], axis=0))
 
 
 class PointWiseFFN(tf.keras.layers.Layer):
     
     def __init__(self, model_dim: int, dense_hidden_units: int, **kwargs):
         super(PointWiseFFN, self).__init__(**kwargs)
-        self.d1 = tf.keras.layers.Dense(dense_hidden_units,
-                                        activation='relu')  # (batch_size, seq_len, dense_hidden_units)
-        self.d2 = tf.keras.layers.Dense(model_dim)  # (batch_size, seq_len, model_dim)
+        self.d1 = FusedDense(dense_hidden_units, activation='relu')  # (batch_size, seq_len, dense_hidden_units)
+        self.d2 = FusedDense(model_dim)  # (batch_size, seq_len, model_dim)
     
     def call(self, x):
         x = self.d1(x)
-        x = self.d2(x)
-        return x
+        return self.d2(x)
 
 
 class FFNResNorm(tf.keras.layers.Layer):
@@ -22,13 +38,13 @@ class FFNResNorm(tf.keras.layers.Layer):
     def __init__(self, model_dim: int, dense_hidden_units: int, dropout_rate: float = 0.1, **kwargs):
         super(FFNResNorm, self).__init__(**kwargs)
         self.ffn = PointWiseFFN(model_dim, dense_hidden_units)
-        self.dropout = tf.keras.layers.Dropout(dropout_rate)
+        self.dropout_rate = dropout_rate
         self.ln = tf.keras.layers.LayerNormalization(epsilon=1e-6)
     
     def call(self, x, training):
         ffn_out = self.ffn(x)  # (batch_size, input_seq_len, model_dim)
-        ffn_out = self.dropout(ffn_out, training=training)
-        out = self.ln(x + ffn_out)  # (batch_size, input_seq_len, model_dim)
+        out = dropout_residual_layer_norm(ffn_out, x, self.ln, self.dropout_rate,
+                                          training=training)  # (batch_size, input_seq_len, model_dim)
         
         return out
 
@@ -46,13 +62,12 @@ class Conv1DResNorm(tf.keras.layers.Layer):
                                            kernel_size=kernel_size,
                                            padding=conv_padding,
                                            activation=activation)
-        self.dropout = tf.keras.layers.Dropout(dropout_rate)
+        self.dropout_rate = dropout_rate
         self.layer_norm = tf.keras.layers.LayerNormalization()
     
     def call(self, x, training):
         convs = self.conv(x)
-        convs = self.dropout(convs, training=training)
-        res_norm = self.layer_norm(x + convs)
+        res_norm = dropout_residual_layer_norm(convs, x, self.layer_norm, self.dropout_rate, training=training)
         return res_norm
 
 
@@ -65,21 +80,23 @@ class HeadDrop(tf.keras.layers.Layer):
     def call(self, batch, training: bool, drop_n_heads: int):
         if not training or (drop_n_heads == 0):
             return batch
-        if len(tf.shape(batch)) != 4:
+        if batch.shape.rank != 4:
             raise Exception('attention values must be 4 dimensional')
         batch_size = tf.shape(batch)[0]
-        head_n = tf.shape(batch)[1]
+        head_n = batch.shape[1]  # static
         if head_n == 1:
             return batch
         # assert drop_n_heads < head_n, 'drop_n_heads must less than number of heads'
-        keep_head_batch = tf.TensorArray(tf.float32, size=batch_size)
-        keep_mask = tf.concat([tf.ones(head_n - drop_n_heads), tf.zeros(drop_n_heads)], axis=0)
-        for i in range(batch_size):
-            t = tf.random.shuffle(keep_mask)
-            keep_head_batch = keep_head_batch.write(i, t)
-        keep_head_batch = keep_head_batch.stack()
+        # keep the heads with the top (head_n - drop_n_heads) random scores: a random permutation per sample
+        scores = tf.random.uniform((batch_size, head_n))
+        keep_heads = tf.math.top_k(scores, k=head_n - drop_n_heads).indices  # (batch_size, head_n - drop_n_heads)
+        keep_head_batch = tf.reduce_sum(tf.one_hot(keep_heads, head_n, dtype=batch.dtype), axis=1)
         keep_head_batch = keep_head_batch[:, :, tf.newaxis, tf.newaxis]
-        return batch * keep_head_batch * tf.cast(head_n / (head_n - drop_n_heads), tf.float32)
+        if isinstance(drop_n_heads, int):
+            scale = head_n / (head_n - drop_n_heads)  # python constant folded in at trace time
+        else:  # a tensor, as passed by train.py
+            scale = tf.cast(head_n, batch.dtype) / tf.cast(head_n - drop_n_heads, batch.dtype)
+        return batch * keep_head_batch * scale
 
 
 class MultiHeadAttention(tf.keras.layers.Layer):
@@ -94,40 +111,89 @@ class MultiHeadAttention(tf.keras.layers.Layer):
         
         self.depth = model_dim // self.num_heads
         
+        self.wqkv = tf.keras.layers.Dense(3 * model_dim)  # fused projection for self-attention
         self.wq = tf.keras.layers.Dense(model_dim)
         self.wk = tf.keras.layers.Dense(model_dim)
         self.wv = tf.keras.layers.Dense(model_dim)
         
-        self.dense = tf.keras.layers.Dense(model_dim)
-    
-    def split_heads(self, x, batch_size: int):
-        """Split the last dimension into (num_heads, depth).
-        Transpose the result such that the shape is (batch_size, num_heads, seq_len, depth)
+        # the output projection of concat([q_in, attention]) split into its two halves,
+        # the attention half is attention_kernel and attention_bias (see build)
+        self.dense_q = FusedDense(model_dim, use_bias=False)
+    
+    def build(self, input_shape):
+        # the same weights as a Dense layer on the concatenated attention heads
+        self.attention_kernel = self.add_weight('attention_kernel', shape=(self.model_dim, self.model_dim),
+                                                initializer='glorot_uniform')
+        self.attention_bias = self.add_weight('attention_bias', shape=(self.model_dim,), initializer='zeros')
+        super(MultiHeadAttention, self).build(input_shape)
+    
+    def project_heads(self, dense, x, n_projections: int = 1):
+        """Apply the kernel of dense to x, producing (n_projections, batch_size, num_heads, seq_len, depth)
+        directly instead of reshaping and transposing the projected tensor.
         """
         
-        x = tf.reshape(x, (batch_size, -1, self.num_heads, self.depth))
-        return tf.transpose(x, perm=[0, 2, 1, 3])
-    
-    def call(self, v, k, q_in, mask, training, drop_n_heads):
-        batch_size = tf.shape(q_in)[0]
+        if not dense.built:
+            dense.build(x.shape)
+        # cast, as the variables are only autocast to the compute dtype within call
+        kernel = tf.reshape(tf.cast(dense.kernel, x.dtype), (-1, n_projections, self.num_heads, self.depth))
+        bias = tf.reshape(tf.cast(dense.bias, x.dtype), (n_projections, 1, self.num_heads, 1, self.depth))
+        return tf.einsum('bsd,dphe->pbhse', x, kernel) + bias
+    
+    def project_kv(self, v, k):
+        """Keys and values projected into heads, to be passed to call as projected_kv."""
+        return {'k': self.project_heads(self.wk, k)[0], 'v': self.project_heads(self.wv, v)[0]}
+    
+    def from_legacy_weights(self, reader, prefix: str, fuse_qkv: bool):
+        """Read the weights of a checkpoint that predates the fused projections with reader (as returned by
+        tf.train.load_checkpoint), where the layer at prefix has separate wq, wk, wv projections and a single output projection dense over concat([q_in, attention]).
+        Copies wq, wk, wv into wqkv if fuse_qkv (i.e. for self-attention, otherwise they are restored as they are)
+        and splits dense into dense_q, attention_kernel and attention_bias.
+        """
         
-        q = self.wq(q_in)  # (batch_size, seq_len, model_dim)
-        k = self.wk(k)  # (batch_size, seq_len, model_dim)
-        v = self.wv(v)  # (batch_size, seq_len, model_dim)
+        def legacy_weight(layer, name):
+            return reader.get_tensor(f'{prefix}/{layer}/{name}/.ATTRIBUTES/VARIABLE_VALUE')
         
-        q = self.split_heads(q, batch_size)  # (batch_size, num_heads, seq_len_q, depth)
-        k = self.split_heads(k, batch_size)  # (batch_size, num_heads, seq_len_k, depth)
-        v = self.split_heads(v, batch_size)  # (batch_size, num_heads, seq_len_v, depth)
+        # the queries have model_dim channels, in self- and cross-attention
+        if fuse_qkv:
+            if not self.wqkv.built:
+                self.wqkv.build(tf.TensorShape([None, self.model_dim]))
+            self.wqkv.kernel.assign(tf.concat([legacy_weight(w, 'kernel') for w in ['wq', 'wk', 'wv']], axis=1))
+            self.wqkv.bias.assign(tf.concat([legacy_weight(w, 'bias') for w in ['wq', 'wk', 'wv']], axis=0))
+        if not self.dense_q.built:
+            self.dense_q.build(tf.TensorShape([None, self.model_dim]))
+        if not self.built:
+            self.build(None)
+        kernel = legacy_weight('dense', 'kernel')
+        self.dense_q.kernel.assign(kernel[:self.model_dim])
+        self.attention_kernel.assign(kernel[self.model_dim:])
+        self.attention_bias.assign(legacy_weight('dense', 'bias'))
+    
+    def call(self, v, k, q_in, mask, training, drop_n_heads, cache=None, projected_kv=None, additive_mask=False):
+        # additive_mask tells whether mask is already in additive form, see create_additive_mask
+        # cache holds the keys and values of the previous time steps in autoregressive decoding and
+        # is updated in place with those of the current ones, which are the only ones projected
+        # projected_kv holds the keys and values already projected by project_kv, which then ignores v and k
+        if projected_kv is not None:
+            q = self.project_heads(self.wq, q_in)[0]
+            k, v = projected_kv['k'], projected_kv['v']
+        elif v is k and k is q_in:
+            q, k, v = tf.unstack(self.project_heads(self.wqkv, q_in, n_projections=3))
+        else:
+            q = self.project_heads(self.wq, q_in)[0]  # (batch_size, num_heads, seq_len_q, depth)
+            k = self.project_heads(self.wk, k)[0]  # (batch_size, num_heads, seq_len_k, depth)
+            v = self.project_heads(self.wv, v)[0]  # (batch_size, num_heads, seq_len_v, depth)
+        if cache is not None:
+            k = tf.concat([cache['k'], k], axis=-2)
+            v = tf.concat([cache['v'], v], axis=-2)
+            cache.update({'k': k, 'v': v})
         
-        scaled_attention, attention_weights = scaled_dot_product_attention(q, k, v, mask)
+        scaled_attention, attention_weights = scaled_dot_product_attention(q, k, v, mask, additive_mask=additive_mask)
         scaled_attention = self.head_drop(scaled_attention, training=training, drop_n_heads=drop_n_heads)
         
-        scaled_attention = tf.transpose(scaled_attention,
-                                        perm=[0, 2, 1, 3])  # (batch_size, seq_len_q, num_heads, depth)
-        concat_attention = tf.reshape(scaled_attention,
-                                      (batch_size, -1, self.model_dim))  # (batch_size, seq_len_q, model_dim)
-        concat_query = tf.concat([q_in, concat_attention], axis=-1)
-        output = self.dense(concat_query)  # (batch_size, seq_len_q, model_dim)
+        # merge the attention heads in the einsum, without transpose and reshape
+        attention_kernel = tf.reshape(self.attention_kernel, (self.num_heads, self.depth, self.model_dim))
+        concat_attention = tf.einsum('bhse,hed->bsd', scaled_attention, attention_kernel) + self.attention_bias
+        output = self.dense_q(q_in) + concat_attention  # (batch_size, seq_len_q, model_dim)
         
         return output, attention_weights
 
@@ -138,13 +204,13 @@ class SelfAttentionResNorm(tf.keras.layers.Layer):
         super(SelfAttentionResNorm, self).__init__(**kwargs)
         self.mha = MultiHeadAttention(model_dim, num_heads)
         self.ln = tf.keras.layers.LayerNormalization(epsilon=1e-6)
-        self.dropout = tf.keras.layers.Dropout(dropout_rate)
+        self.dropout_rate = dropout_rate
     
-    def call(self, x, training, mask, drop_n_heads):
-        attn_out, attn_weights = self.mha(x, x, x, mask, training=training,
-                                          drop_n_heads=drop_n_heads)  # (batch_size, input_seq_len, model_dim)
-        attn_out = self.dropout(attn_out, training=training)
-        out = self.ln(x + attn_out)  # (batch_size, input_seq_len, model_dim)
+    def call(self, x, training, mask, drop_n_heads, cache=None, additive_mask=False):
+        attn_out, attn_weights = self.mha(x, x, x, mask, training=training, drop_n_heads=drop_n_heads,
+                                          cache=cache, additive_mask=additive_mask)  # (batch_size, input_seq_len, model_dim)
+        out = dropout_residual_layer_norm(attn_out, x, self.ln, self.dropout_rate,
+                                          training=training)  # (batch_size, input_seq_len, model_dim)
         return out, attn_weights
 
 
@@ -155,8 +221,9 @@ class SelfAttentionDenseBlock(tf.keras.layers.Layer):
         self.sarn = SelfAttentionResNorm(model_dim, num_heads, dropout_rate=dropout_rate)
         self.ffn = FFNResNorm(model_dim, dense_hidden_units)
     
-    def call(self, x, training, mask, drop_n_heads):
-        attn_out, attn_weights = self.sarn(x, mask=mask, training=training, drop_n_heads=drop_n_heads)
+    def call(self, x, training, mask, drop_n_heads, additive_mask=False):
+        attn_out, attn_weights = self.sarn(x, mask=mask, training=training, drop_n_heads=drop_n_heads,
+                                           additive_mask=additive_mask)
         return self.ffn(attn_out, training=training), attn_weights
 
 
@@ -175,8 +242,9 @@ class SelfAttentionConvBlock(tf.keras.layers.Layer):
         self.conv = Conv1DResNorm(model_dim=model_dim, dropout_rate=dropout_rate, kernel_size=kernel_size,
                                   conv_padding=conv_padding, activation=conv_activation)
     
-    def call(self, x, training, mask, drop_n_heads):
-        attn_out, attn_weights = self.sarn(x, mask=mask, training=training, drop_n_heads=drop_n_heads)
+    def call(self, x, training, mask, drop_n_heads, additive_mask=False):
+        attn_out, attn_weights = self.sarn(x, mask=mask, training=training, drop_n_heads=drop_n_heads,
+                                           additive_mask=additive_mask)
         return self.conv(attn_out, training=training), attn_weights
 
 
@@ -191,8 +259,9 @@ class SelfAttentionBlocks(tf.keras.layers.Layer):
                  **kwargs):
         super(SelfAttentionBlocks, self).__init__(**kwargs)
         self.model_dim = model_dim
+        self.dim_scale = math.sqrt(model_dim)
         self.pos_encoding_scalar = tf.Variable(1.)
-        self.pos_encoding = positional_encoding(maximum_position_encoding, model_dim)
+        self.pos_encoding = tf.cast(positional_encoding(maximum_position_encoding, model_dim), self.compute_dtype)
         self.dropout = tf.keras.layers.Dropout(dropout_rate)
         self.encoder_SADB = [
             SelfAttentionDenseBlock(model_dim=model_dim, dropout_rate=dropout_rate, num_heads=n_heads,
@@ -202,21 +271,25 @@ class SelfAttentionBlocks(tf.keras.layers.Layer):
             SelfAttentionConvBlock(model_dim=model_dim, dropout_rate=dropout_rate, num_heads=n_heads,
                                    name=f'{self.name}_SACB_{i}')
             for i, n_heads in enumerate(num_heads[dense_blocks:])]
+        # names of the stacked attention weights returned by call, e.g. for logging
+        self.attention_names = [f'{self.name}_DenseBlock{i + 1}_SelfAttention' for i in range(len(self.encoder_SADB))]
+        self.attention_names += [f'{self.name}_ConvBlock{i + 1}_SelfAttention' for i in range(len(self.encoder_SACB))]
     
     def call(self, inputs, training, padding_mask, drop_n_heads, reduction_factor=1):
         seq_len = tf.shape(inputs)[1]
-        x = inputs * tf.math.sqrt(tf.cast(self.model_dim, tf.float32))
-        x += self.pos_encoding_scalar * self.pos_encoding[:, :seq_len * reduction_factor:reduction_factor, :]
+        x = inputs * self.dim_scale
+        pos_encoding_scalar = tf.cast(self.pos_encoding_scalar, x.dtype)
+        x += pos_encoding_scalar * self.pos_encoding[:, :seq_len * reduction_factor:reduction_factor, :]
         x = self.dropout(x, training=training)
-        attention_weights = {}
-        for i, block in enumerate(self.encoder_SADB):
-            x, attn_weights = block(x, training=training, mask=padding_mask, drop_n_heads=drop_n_heads)
-            attention_weights[f'{self.name}_DenseBlock{i + 1}_SelfAttention'] = attn_weights
-        for i, block in enumerate(self.encoder_SACB):
-            x, attn_weights = block(x, training=training, mask=padding_mask, drop_n_heads=drop_n_heads)
-            attention_weights[f'{self.name}_ConvBlock{i + 1}_SelfAttention'] = attn_weights
+        # prepared once for all the blocks
+        padding_mask = create_additive_mask(padding_mask, x.dtype)
+        attention_weights = []
+        for block in self.encoder_SADB + self.encoder_SACB:
+            x, attn_weights = block(x, training=training, mask=padding_mask, drop_n_heads=drop_n_heads,
+                                    additive_mask=True)
+            attention_weights.append(attn_weights)
         
-        return x, attention_weights
+        return x, stack_attention_weights(attention_weights)
 
 
 class CrossAttentionResnorm(tf.keras.layers.Layer):
@@ -225,12 +298,16 @@ class CrossAttentionResnorm(tf.keras.layers.Layer):
         super(CrossAttentionResnorm, self).__init__(**kwargs)
         self.mha = MultiHeadAttention(model_dim, num_heads)
         self.layernorm = tf.keras.layers.LayerNormalization(epsilon=1e-6)
-        self.dropout = tf.keras.layers.Dropout(dropout_rate)
+        self.dropout_rate = dropout_rate
     
-    def call(self, q, k, v, training, mask, drop_n_heads):
-        attn_values, attn_weights = self.mha(v, k=k, q_in=q, mask=mask, training=training, drop_n_heads=drop_n_heads)
-        attn_values = self.dropout(attn_values, training=training)
-        out = self.layernorm(attn_values + q)
+    def prepare(self, enc_output):
+        """Project the keys and values of enc_output once, to be passed to call as projected_kv."""
+        return self.mha.project_kv(enc_output, enc_output)
+    
+    def call(self, q, k, v, training, mask, drop_n_heads, projected_kv=None, additive_mask=False):
+        attn_values, attn_weights = self.mha(v, k=k, q_in=q, mask=mask, training=training, drop_n_heads=drop_n_heads,
+                                             projected_kv=projected_kv, additive_mask=additive_mask)
+        out = dropout_residual_layer_norm(attn_values, q, self.layernorm, self.dropout_rate, training=training)
         return out, attn_weights
 
 
@@ -242,11 +319,15 @@ class CrossAttentionDenseBlock(tf.keras.layers.Layer):
         self.carn = CrossAttentionResnorm(model_dim, num_heads, dropout_rate=dropout_rate)
         self.ffn = FFNResNorm(model_dim, dense_hidden_units, dropout_rate=dropout_rate)
     
-    def call(self, x, enc_output, training, look_ahead_mask, padding_mask, drop_n_heads):
-        attn1, attn_weights_block1 = self.sarn(x, mask=look_ahead_mask, training=training, drop_n_heads=drop_n_heads)
+    def call(self, x, enc_output, training, look_ahead_mask, padding_mask, drop_n_heads, cache=None,
+             additive_mask=False):
+        cache = cache or {}
+        attn1, attn_weights_block1 = self.sarn(x, mask=look_ahead_mask, training=training, drop_n_heads=drop_n_heads,
+                                               cache=cache.get('self_attention'), additive_mask=additive_mask)
         
         attn2, attn_weights_block2 = self.carn(attn1, v=enc_output, k=enc_output,
-                                               mask=padding_mask, training=training, drop_n_heads=drop_n_heads)
+                                               mask=padding_mask, training=training, drop_n_heads=drop_n_heads,
+                                               projected_kv=cache.get('cross_attention'), additive_mask=additive_mask)
         ffn_out = self.ffn(attn2, training=training)
         return ffn_out, attn_weights_block1, attn_weights_block2
 
@@ -267,11 +348,15 @@ class CrossAttentionConvBlock(tf.keras.layers.Layer):
         self.conv = Conv1DResNorm(model_dim=model_dim, dropout_rate=dropout_rate, kernel_size=kernel_size,
                                   conv_padding=conv_padding, activation=conv_activation)
     
-    def call(self, x, enc_output, training, look_ahead_mask, padding_mask, drop_n_heads):
-        attn1, attn_weights_block1 = self.sarn(x, mask=look_ahead_mask, training=training, drop_n_heads=drop_n_heads)
+    def call(self, x, enc_output, training, look_ahead_mask, padding_mask, drop_n_heads, cache=None,
+             additive_mask=False):
+        cache = cache or {}
+        attn1, attn_weights_block1 = self.sarn(x, mask=look_ahead_mask, training=training, drop_n_heads=drop_n_heads,
+                                               additive_mask=additive_mask)
         
         attn2, attn_weights_block2 = self.carn(attn1, v=enc_output, k=enc_output,
-                                               mask=padding_mask, training=training, drop_n_heads=drop_n_heads)
+                                               mask=padding_mask, training=training, drop_n_heads=drop_n_heads,
+                                               projected_kv=cache.get('cross_attention'), additive_mask=additive_mask)
         ffn_out = self.conv(attn2, training=training)
         return ffn_out, attn_weights_block1, attn_weights_block2
 
@@ -288,8 +373,9 @@ class CrossAttentionBlocks(tf.keras.layers.Layer):
                  **kwargs):
         super(CrossAttentionBlocks, self).__init__(**kwargs)
         self.model_dim = model_dim
+        self.dim_scale = math.sqrt(model_dim)
         self.pos_encoding_scalar = tf.Variable(1.)
-        self.pos_encoding = positional_encoding(maximum_position_encoding, model_dim)
+        self.pos_encoding = tf.cast(positional_encoding(maximum_position_encoding, model_dim), self.compute_dtype)
         self.dropout = tf.keras.layers.Dropout(dropout_rate)
         self.CADB = [
             CrossAttentionDenseBlock(model_dim=model_dim, dropout_rate=dropout_rate, num_heads=n_heads,
@@ -299,44 +385,122 @@ class CrossAttentionBlocks(tf.keras.layers.Layer):
             CrossAttentionConvBlock(model_dim=model_dim, dropout_rate=dropout_rate, num_heads=n_heads,
                                     name=f'{self.name}_CACB_{i}')
             for i, n_heads in enumerate(num_heads[dense_blocks:])]
+        # names of the stacked attention weights returned by call, e.g. for logging
+        self.attention_names = [f'{self.name}_DenseBlock{i + 1}_CrossAttention' for i in range(len(self.CADB))]
+        self.attention_names += [f'{self.name}_ConvBlock{i + 1}_CrossAttention' for i in range(len(self.CACB))]
+        self.self_attention_names = [f'{self.name}_DenseBlock{i + 1}_SelfAttention' for i in range(len(self.CADB))]
+        self.self_attention_names += [f'{self.name}_ConvBlock{i + 1}_SelfAttention' for i in range(len(self.CACB))]
     
     def call(self, inputs, enc_output, training, decoder_padding_mask, encoder_padding_mask, drop_n_heads,
              reduction_factor=1):
         seq_len = tf.shape(inputs)[1]
-        x = inputs * tf.math.sqrt(tf.cast(self.model_dim, tf.float32))
-        x += self.pos_encoding_scalar * self.pos_encoding[:, :seq_len * reduction_factor:reduction_factor, :]
+        x = inputs * self.dim_scale
+        pos_encoding_scalar = tf.cast(self.pos_encoding_scalar, x.dtype)
+        x += pos_encoding_scalar * self.pos_encoding[:, :seq_len * reduction_factor:reduction_factor, :]
         x = self.dropout(x, training=training)
-        attention_weights = {}
-        for i, block in enumerate(self.CADB):
-            x, _, attn_weights = block(x, enc_output, training, decoder_padding_mask, encoder_padding_mask,
-                                       drop_n_heads)
-            attention_weights[f'{self.name}_DenseBlock{i + 1}_CrossAttention'] = attn_weights
-        for i, block in enumerate(self.CACB):
-            x, _, attn_weights = block(x, enc_output, training, decoder_padding_mask, encoder_padding_mask,
-                                       drop_n_heads)
-            attention_weights[f'{self.name}_ConvBlock{i + 1}_CrossAttention'] = attn_weights
+        return self._call_blocks(x, enc_output, training, decoder_padding_mask, encoder_padding_mask, drop_n_heads)
+    
+    def cache_signature(self, dtype):
+        """Structure of the cache used by call_step: for each block the cross-attention keys and values of
+        the encoder output and, for dense blocks, the self-attention keys and values of the previous time steps.
+        If there are conv blocks, also their inputs at the previous time steps.
+        """
+        
+        def kv_signature(mha):
+            spec = tf.TensorSpec(shape=(None, mha.num_heads, None, mha.depth), dtype=dtype)
+            return {'k': spec, 'v': spec}
         
-        return x, attention_weights
+        signature = {}
+        for block in self.CADB:
+            signature[block.name] = {'self_attention': kv_signature(block.sarn.mha),
+                                     'cross_attention': kv_signature(block.carn.mha)}
+        for block in self.CACB:
+            signature[block.name] = {'cross_attention': kv_signature(block.carn.mha)}
+        if self.CACB:
+            signature['conv_input'] = tf.TensorSpec(shape=(None, None, self.model_dim), dtype=dtype)
+        return signature
+    
+    def initial_cache(self, enc_output):
+        """Cache for call_step before the first time step. The cross-attention keys and values are the
+        same at every time step, so they are projected here once.
+        """
+        
+        batch_size = tf.shape(enc_output)[0]
+        cache = {}
+        for block in self.CADB + self.CACB:
+            cache[block.name] = {'cross_attention': block.carn.prepare(enc_output)}
+        for block in self.CADB:
+            empty = tf.zeros((batch_size, block.sarn.mha.num_heads, 0, block.sarn.mha.depth), enc_output.dtype)
+            cache[block.name]['self_attention'] = {'k': empty, 'v': empty}
+        if self.CACB:
+            cache['conv_input'] = tf.zeros((batch_size, 0, self.model_dim), enc_output.dtype)
+        return cache
+    
+    def call_step(self, inputs, step, enc_output, encoder_padding_mask, cache, reduction_factor=1):
+        """Decode the newest time step in autoregressive inference, given its prenet output only.
+        The newest step is embedded reading a single row of the positional encoding table and only its
+        keys and values are projected, attending to the ones of the previous steps in cache (see initial_cache).
+        Conv blocks are not causal ('same' padding), so they are still applied to all the time steps.
+        
+        Returns the output (of all the time steps if there are conv blocks, of the newest one otherwise),
+        the cross-attention weights of the newest step and the cache updated with it.
+        """
+        
+        position = step * reduction_factor
+        x = inputs * self.dim_scale
+        x += tf.cast(self.pos_encoding_scalar, x.dtype) * self.pos_encoding[:, position:position + 1, :]
+        encoder_padding_mask = create_additive_mask(encoder_padding_mask, x.dtype)
+        new_cache = {}
+        attention_weights = []
+        for block in self.CADB:
+            new_cache[block.name] = {'self_attention': dict(cache[block.name]['self_attention']),  # updated in place
+                                     'cross_attention': cache[block.name]['cross_attention']}
+            x, _, attn_weights = block(x, enc_output, False, None, encoder_padding_mask, drop_n_heads=0,
+                                       cache=new_cache[block.name], additive_mask=True)
+            attention_weights.append(attn_weights)
+        if self.CACB:
+            x = tf.concat([cache['conv_input'], x], axis=1)
+            new_cache['conv_input'] = x
+            look_ahead_mask = create_additive_mask(create_look_ahead_mask(tf.shape(x)[1]), x.dtype)
+            for block in self.CACB:
+                new_cache[block.name] = cache[block.name]
+                x, _, attn_weights = block(x, enc_output, False, look_ahead_mask, encoder_padding_mask,
+                                           drop_n_heads=0, cache=cache[block.name], additive_mask=True)
+                attention_weights.append(attn_weights[:, :, -1:, :])
+        return x, stack_attention_weights(attention_weights), new_cache
+    
+    def _call_blocks(self, x, enc_output, training, decoder_padding_mask, encoder_padding_mask, drop_n_heads):
+        # prepared once for all the blocks
+        decoder_padding_mask = create_additive_mask(decoder_padding_mask, x.dtype)
+        encoder_padding_mask = create_additive_mask(encoder_padding_mask, x.dtype)
+        attention_weights = []
+        self_attention_weights = []
+        for block in self.CADB + self.CACB:
+            x, self_attn_weights, attn_weights = block(x, enc_output, training, decoder_padding_mask,
+                                                       encoder_padding_mask, drop_n_heads, additive_mask=True)
+            self_attention_weights.append(self_attn_weights)
+            attention_weights.append(attn_weights)
+        
+        return x, stack_attention_weights(attention_weights), stack_attention_weights(self_attention_weights)
 
 
 class DecoderPrenet(tf.keras.layers.Layer):
     
     def __init__(self, model_dim: int, dense_hidden_units: int, dropout_rate: float = 0.5, **kwargs):
         super(DecoderPrenet, self).__init__(**kwargs)
-        self.d1 = tf.keras.layers.Dense(dense_hidden_units,
-                                        activation='relu')  # (batch_size, seq_len, dense_hidden_units)
-        self.d2 = tf.keras.layers.Dense(model_dim, activation='relu')  # (batch_size, seq_len, model_dim)
-        self.dropout_1 = tf.keras.layers.Dropout(dropout_rate)
-        self.dropout_2 = tf.keras.layers.Dropout(dropout_rate)
-    
-    def call(self, x, dropout_rate: float = 0.5):
-        self.dropout_1.dropout_rate = dropout_rate
-        self.dropout_2.dropout_rate = dropout_rate
+        self.d1 = FusedDense(dense_hidden_units, activation='relu')  # (batch_size, seq_len, dense_hidden_units)
+        self.d2 = FusedDense(model_dim, activation='relu')  # (batch_size, seq_len, model_dim)
+        # a variable, so that changing the rate takes effect in already traced functions
+        self.rate = tf.Variable(dropout_rate, trainable=False, dtype=tf.float32)
+    
+    def call(self, x):
+        rate = tf.cast(self.rate, x.dtype)
         x = self.d1(x)
         # use dropout also in inference for additional noise as suggested in the original tacotron2 paper
-        x = self.dropout_1(x, training=True)
+        # channel-wise: the same channels are dropped at all time steps, so the masks are seq_len times smaller
+        x = tf.nn.dropout(x, rate=rate, noise_shape=(tf.shape(x)[0], 1, x.shape[-1]))
         x = self.d2(x)
-        x = self.dropout_2(x, training=True)
+        x = tf.nn.dropout(x, rate=rate, noise_shape=(tf.shape(x)[0], 1, x.shape[-1]))
         return x
 
 
@@ -344,51 +508,122 @@ class ConvBatchNormBlock(tf.keras.layers.Layer):
     
     def __init__(self, out_size: int, n_filters: int = 256, n_layers: int = 5, kernel_size: int = 5,
                  dropout_prob: float = 0.5, padding='causal', inner_activation='tanh',
-                 last_activation='linear', **kwargs):
+                 last_activation='linear', separable: bool = False, **kwargs):
         super(ConvBatchNormBlock, self).__init__(**kwargs)
-        self.convolutions = [tf.keras.layers.Conv1D(filters=n_filters,
-                                                    kernel_size=kernel_size,
-                                                    padding=padding,
-                                                    activation=inner_activation)
+        # separable blocks use depthwise separable convolutions and apply the activations
+        # after the batch normalizations, so that all of these can be folded into the convolutions
+        self.separable = separable
+        if separable:
+            conv_layer = tf.keras.layers.SeparableConv1D
+            self.inner_activation = tf.keras.activations.get(inner_activation)
+            self.last_activation = tf.keras.activations.get(last_activation)
+            inner_activation, last_activation = 'linear', 'linear'
+        else:
+            conv_layer = tf.keras.layers.Conv1D
+        self.convolutions = [conv_layer(filters=n_filters,
+                                        kernel_size=kernel_size,
+                                        padding=padding,
+                                        activation=inner_activation)
                              for _ in range(n_layers - 1)]
         self.dropouts = [tf.keras.layers.Dropout(dropout_prob) for _ in range(n_layers - 1)]
-        self.last_conv = tf.keras.layers.Conv1D(filters=out_size,
-                                                kernel_size=kernel_size,
-                                                padding=padding,
-                                                activation=last_activation)
+        self.last_conv = conv_layer(filters=out_size,
+                                    kernel_size=kernel_size,
+                                    padding=padding,
+                                    activation=last_activation)
         self.batch_norms = [tf.keras.layers.BatchNormalization() for _ in range(n_layers)]
+        # inference-only copies of the convolutions with the batch normalizations folded in, see fold_batch_norms;
+        # not tracked, so that they are neither trained nor saved
+        self.folded_convolutions = self._no_dependency([None] * n_layers)
+    
+    def fold_batch_norms(self, input_dim: int):
+        """Fold the inference-mode batch normalizations into copies of the kernel and bias of the preceding
+        convolutions that have no activation in between, which call uses instead of both at inference time.
+        The trained weights are left as they are: fold again after updating them.
+        """
+        
+        for i, (conv, batch_norm) in enumerate(zip(self.convolutions + [self.last_conv], self.batch_norms)):
+            input_shape = tf.TensorShape([None, None, input_dim])
+            # building the layers triggers the deferred checkpoint restoration of their variables
+            if not conv.built:
+                conv.build(input_shape)
+            if not batch_norm.built:
+                batch_norm.build(tf.TensorShape([None, None, conv.filters]))
+            input_dim = conv.filters
+            if tf.keras.activations.serialize(conv.activation) != 'linear':
+                continue
+            scale = batch_norm.gamma / tf.sqrt(batch_norm.moving_variance + batch_norm.epsilon)
+            bias = (conv.bias - batch_norm.moving_mean) * scale + batch_norm.beta
+            if self.separable:
+                weights = [conv.depthwise_kernel, conv.pointwise_kernel * scale, bias]
+            else:
+                weights = [conv.kernel * scale, bias]
+            folded_conv = conv.__class__.from_config(conv.get_config())
+            folded_conv.build(input_shape)
+            folded_conv.set_weights([weight.numpy() for weight in weights])
+            self.folded_convolutions[i] = folded_conv
     
     def call(self, x, training):
         for i in range(0, len(self.convolutions)):
-            x = self.convolutions[i](x)
-            x = self.batch_norms[i](x, training=training)
+            if not training and self.folded_convolutions[i] is not None:
+                x = self.folded_convolutions[i](x)
+            else:
+                x = self.convolutions[i](x)
+                x = self.batch_norms[i](x, training=training)
+            if self.separable:
+                x = self.inner_activation(x)
             x = self.dropouts[i](x, training=training)
-        x = self.last_conv(x)
-        x = self.batch_norms[-1](x, training=training)
+        if not training and self.folded_convolutions[-1] is not None:
+            x = self.folded_convolutions[-1](x)
+        else:
+            x = self.last_conv(x)
+            x = self.batch_norms[-1](x, training=training)
+        if self.separable:
+            x = self.last_activation(x)
         return x
 
 
 class Postnet(tf.keras.layers.Layer):
     
     def __init__(self, mel_channels: int, conv_filters: int = 256, conv_layers: int = 5, kernel_size: int = 5,
-                 **kwargs):
+                 separable_convs: bool = False, **kwargs):
         super(Postnet, self).__init__(**kwargs)
         self.mel_channels = mel_channels
-        self.stop_linear = tf.keras.layers.Dense(3)
+        # number of previous frames the (causal) convolutions see
+        self.receptive_field = conv_layers * (kernel_size - 1)
+        self.stop_linear = FusedDense(3)
         self.postnet_conv_layers = ConvBatchNormBlock(
-            out_size=mel_channels, n_filters=conv_filters, n_layers=conv_layers, kernel_size=kernel_size
+            out_size=mel_channels, n_filters=conv_filters, n_layers=conv_layers, kernel_size=kernel_size,
+            separable=separable_convs
         )
         self.add_layer = tf.keras.layers.Add()
     
     def call(self, x, training):
         stop = self.stop_linear(x)
         conv_out = self.conv_net(x, training=training)
+        # outputs are compared with the float32 targets also when computing in mixed precision
+        return {
+            'mel_linear': tf.cast(x, tf.float32),
+            'final_output': tf.cast(conv_out, tf.float32),
+            'stop_prob': tf.cast(stop, tf.float32),
+        }
+    
+    def call_step(self, x, new_frames: int):
+        """Outputs for the last new_frames frames of x in autoregressive inference, given the previous frames
+        within the receptive field of the convolutions. The stop probability is only computed for the last
+        frame, the only one the decoding loop reads.
+        """
+        
+        stop = self.stop_linear(x[:, -1:, :])
+        conv_out = self.conv_net(x, training=False)[:, -new_frames:, :]
         return {
-            'mel_linear': x,
-            'final_output': conv_out,
-            'stop_prob': stop,
+            'mel_linear': tf.cast(x[:, -new_frames:, :], tf.float32),
+            'final_output': tf.cast(conv_out, tf.float32),
+            'stop_prob': tf.cast(stop, tf.float32),
         }
     
+    def fold_batch_norms(self):
+        self.postnet_conv_layers.fold_batch_norms(input_dim=self.mel_channels)
+    
     def conv_net(self, x, *, training):
         conv_out = self.postnet_conv_layers(x, training)
         x = self.add_layer([conv_out, x])
@@ -4,11 +4,11 @@ import tensorflow as tf
 
 from model.transformer_utils import create_encoder_padding_mask, create_mel_padding_mask, create_look_ahead_mask
 from utils.losses import weighted_sum_losses
-from model.layers import DecoderPrenet, Postnet
+from model.layers import DecoderPrenet, Postnet, FusedDense
 from utils.losses import masked_mean_absolute_error, new_scaled_crossentropy
 from preprocessing.data_handling import Tokenizer
 from preprocessing.text_processing import _phonemes, Phonemizer, _punctuations
-from model.layers import SelfAttentionBlocks, CrossAttentionBlocks
+from model.layers import SelfAttentionBlocks, CrossAttentionBlocks, SelfAttentionResNorm
 
 
 class AutoregressiveTransformer(tf.keras.models.Model):
@@ -36,7 +36,9 @@ class AutoregressiveTransformer(tf.keras.models.Model):
                  max_r: int = 10,
                  phoneme_language: str = 'en',
                  decoder_prenet_dropout=0.,
+                 postnet_separable_convs=False,
                  debug=False,
+                 jit_compile=False,
                  **kwargs):
         super(AutoregressiveTransformer, self).__init__(**kwargs)
         self.start_vec = tf.ones((1, mel_channels), dtype=tf.float32) * mel_start_value
@@ -61,6 +63,7 @@ class AutoregressiveTransformer(tf.keras.models.Model):
                                            name='Encoder')
         self.decoder_prenet = DecoderPrenet(model_dim=decoder_model_dimension,
                                             dense_hidden_units=decoder_prenet_dimension,
+                                            dropout_rate=decoder_prenet_dropout,
                                             name='DecoderPrenet')
         self.decoder = CrossAttentionBlocks(model_dim=decoder_model_dimension,
                                             dropout_rate=dropout_rate,
@@ -69,11 +72,12 @@ class AutoregressiveTransformer(tf.keras.models.Model):
                                             maximum_position_encoding=decoder_maximum_position_encoding,
                                             dense_blocks=decoder_dense_blocks,
                                             name='Decoder')
-        self.final_proj_mel = tf.keras.layers.Dense(self.mel_channels * self.max_r, name='FinalProj')
+        self.final_proj_mel = FusedDense(self.mel_channels * self.max_r, name='FinalProj')
         self.decoder_postnet = Postnet(mel_channels=mel_channels,
                                        conv_filters=postnet_conv_filters,
                                        conv_layers=postnet_conv_layers,
                                        kernel_size=postnet_kernel_size,
+                                       separable_convs=postnet_separable_convs,
                                        name='Postnet')
         
         self.training_input_signature = [
@@ -89,11 +93,21 @@ class AutoregressiveTransformer(tf.keras.models.Model):
             tf.TensorSpec(shape=(None, None), dtype=tf.int32)
         ]
         self.decoder_signature = [
-            tf.TensorSpec(shape=(None, None, encoder_model_dimension), dtype=tf.float32),
+            tf.TensorSpec(shape=(None, None, encoder_model_dimension), dtype=self.compute_dtype),
             tf.TensorSpec(shape=(None, None, mel_channels), dtype=tf.float32),
-            tf.TensorSpec(shape=(None, None, None, None), dtype=tf.float32),
+            tf.TensorSpec(shape=(None, None, None, None), dtype=tf.int8),
         ]
+        # not tracked, as keras would wrap the nested decoding state dicts
+        self.decoder_step_signature = self._no_dependency([
+            tf.TensorSpec(shape=(None, None, encoder_model_dimension), dtype=self.compute_dtype),
+            tf.TensorSpec(shape=(None, 1, mel_channels), dtype=tf.float32),
+            {'decoder': self.decoder.cache_signature(self.compute_dtype),
+             'mel': tf.TensorSpec(shape=(None, None, mel_channels), dtype=self.compute_dtype)},
+            tf.TensorSpec(shape=(), dtype=tf.int32),
+            tf.TensorSpec(shape=(None, None, None, None), dtype=tf.int8),
+        ])
         self.debug = debug
+        self.jit_compile = jit_compile
         self.__apply_all_signatures()
     
     @property
@@ -105,11 +119,18 @@ class AutoregressiveTransformer(tf.keras.models.Model):
         self.train_step = self.__apply_signature(self._train_step, self.training_input_signature)
         self.val_step = self.__apply_signature(self._val_step, self.training_input_signature)
         self.forward_encoder = self.__apply_signature(self._forward_encoder, self.encoder_signature)
-        self.forward_decoder = self.__apply_signature(self._forward_decoder, self.decoder_signature)
+        # the decoding loops call these with inputs growing at every step, which XLA would compile each time
+        self.forward_decoder = self.__apply_signature(self._forward_decoder, self.decoder_signature,
+                                                      jit_compile=False)
+        self.forward_decoder_step = self.__apply_signature(self._forward_decoder_step, self.decoder_step_signature,
+                                                           jit_compile=False)
     
-    def __apply_signature(self, function, signature):
+    def __apply_signature(self, function, signature, jit_compile=True):
         if self.debug:
             return function
+        elif self.jit_compile and jit_compile:
+            # lets XLA fuse e.g. the attention chain into a single kernel, compiling once per input shape
+            return tf.function(input_signature=signature, jit_compile=True)(function)
         else:
             return tf.function(input_signature=signature)(function)
     
@@ -126,21 +147,27 @@ class AutoregressiveTransformer(tf.keras.models.Model):
         dec_target_padding_mask = create_mel_padding_mask(targets)
         look_ahead_mask = create_look_ahead_mask(tf.shape(targets)[1])
         combined_mask = tf.maximum(dec_target_padding_mask, look_ahead_mask)
-        dec_input = self.decoder_prenet(targets, training=training, dropout_rate=self.decoder_prenet_dropout)
-        dec_output, attention_weights = self.decoder(inputs=dec_input,
-                                                     enc_output=encoder_output,
-                                                     training=training,
-                                                     decoder_padding_mask=combined_mask,
-                                                     encoder_padding_mask=encoder_padding_mask,
-                                                     drop_n_heads=self.drop_n_heads,
-                                                     reduction_factor=self.r)
+        dec_input = self.decoder_prenet(targets, training=training)
+        dec_output, attention_weights, self_attention_weights = self.decoder(inputs=dec_input,
+                                                                             enc_output=encoder_output,
+                                                                             training=training,
+                                                                             decoder_padding_mask=combined_mask,
+                                                                             encoder_padding_mask=encoder_padding_mask,
+                                                                             drop_n_heads=self.drop_n_heads,
+                                                                             reduction_factor=self.r)
+        model_output = self._call_postnet(dec_output, training)
+        model_output.update({'decoder_attention': attention_weights,
+                             'decoder_self_attention': self_attention_weights,
+                             'decoder_output': dec_output})
+        return model_output
+    
+    def _call_postnet(self, dec_output, training):
         out_proj = self.final_proj_mel(dec_output)[:, :, :self.r * self.mel_channels]
         b = int(tf.shape(out_proj)[0])
         t = int(tf.shape(out_proj)[1])
         mel = tf.reshape(out_proj, (b, t * self.r, self.mel_channels))
         model_output = self.decoder_postnet(mel, training=training)
-        model_output.update(
-            {'decoder_attention': attention_weights, 'decoder_output': dec_output, 'out_proj': out_proj})
+        model_output.update({'out_proj': out_proj})
         return model_output
     
     def _forward(self, inp, output):
@@ -155,6 +182,37 @@ class AutoregressiveTransformer(tf.keras.models.Model):
     def _forward_decoder(self, encoder_output, targets, encoder_padding_mask):
         return self._call_decoder(encoder_output, targets, encoder_padding_mask, training=False)
     
+    def _forward_decoder_step(self, encoder_output, target, decoding_state, step, encoder_padding_mask):
+        """ Decodes the time step step, given only its input frame target and the decoding_state of the
+            previous steps (see predict). Returns the outputs for the new frames and the new decoding_state.
+        """
+        dec_input = self.decoder_prenet(target, training=False)
+        dec_output, attention_weights, decoder_cache = self.decoder.call_step(
+            dec_input,
+            step=step,
+            enc_output=encoder_output,
+            encoder_padding_mask=encoder_padding_mask,
+            cache=decoding_state['decoder'],
+            reduction_factor=self.r)
+        # the causal postnet convolutions need the previous frames within their receptive field only
+        context_steps = -(-self.decoder_postnet.receptive_field // self.r)
+        if self.decoder.CACB:
+            # the decoder outputs of the previous steps change too, hence their frames are recomputed
+            out_proj = self.final_proj_mel(dec_output[:, -(context_steps + 1):, :])[:, :, :self.r * self.mel_channels]
+            mel = tf.reshape(out_proj, (tf.shape(out_proj)[0], -1, self.mel_channels))
+            mel_context = decoding_state['mel']
+        else:
+            out_proj = self.final_proj_mel(dec_output)[:, :, :self.r * self.mel_channels]
+            mel = tf.reshape(out_proj, (tf.shape(out_proj)[0], self.r, self.mel_channels))
+            mel = tf.concat([decoding_state['mel'], mel], axis=1)
+            mel_context = mel[:, -context_steps * self.r:, :] if context_steps > 0 else mel[:, :0, :]
+        model_output = self.decoder_postnet.call_step(mel, new_frames=self.r)
+        model_output.update({'decoder_attention': attention_weights,
+                             'decoder_output': dec_output[:, -1:, :],
+                             'out_proj': out_proj[:, -1:, :],
+                             'decoding_state': {'decoder': decoder_cache, 'mel': mel_context}})
+        return model_output
+    
     def _gta_forward(self, inp, tar, stop_prob, training):
         tar_inp = tar[:, :-1]
         tar_real = tar[:, 1:]
@@ -216,29 +274,57 @@ class AutoregressiveTransformer(tf.keras.models.Model):
         inp = tf.cast(tf.expand_dims(inp, 0), tf.int32)
         output = tf.cast(tf.expand_dims(self.start_vec, 0), tf.float32)
         output_concat = tf.cast(tf.expand_dims(self.start_vec, 0), tf.float32)
-        out_dict = {}
         encoder_output, padding_mask, encoder_attention = self.forward_encoder(inp)
+        # cached decoder keys and values and the last mel frames of the previous time steps
+        decoding_state = {'decoder': self.decoder.initial_cache(encoder_output),
+                          'mel': tf.zeros((1, 0, self.mel_channels), dtype=encoder_output.dtype)}
+        decoder_attention = []
         for i in range(int(max_length // self.r) + 1):
-            model_out = self.forward_decoder(encoder_output, output, padding_mask)
+            model_out = self.forward_decoder_step(encoder_output, output[:, -1:, :], decoding_state, i, padding_mask)
+            decoding_state = model_out['decoding_state']
+            decoder_attention.append(model_out['decoder_attention'])
             output = tf.concat([output, model_out['final_output'][:1, -1:, :]], axis=-2)
             output_concat = tf.concat([tf.cast(output_concat, tf.float32), model_out['final_output'][:1, -self.r:, :]],
                                       axis=-2)
             stop_pred = model_out['stop_prob'][:, -1]
-            out_dict = {'mel': output_concat[0, 1:, :],
-                        'decoder_attention': model_out['decoder_attention'],
-                        'encoder_attention': encoder_attention}
             if verbose:
                 sys.stdout.write(f'\rpred text mel: {i} stop out: {float(stop_pred[0, 2])}')
             if int(tf.argmax(stop_pred, axis=-1)) == self.stop_prob_index:
                 if verbose:
                     print('Stopping')
                 break
+        out_dict = {'mel': output_concat[0, 1:, :],
+                    'decoder_attention': tf.concat(decoder_attention, axis=-2),  # one query step at a time
+                    'encoder_attention': encoder_attention}
         return out_dict
     
+    def from_legacy_weights(self, checkpoint_path: str, prefix: str = 'net'):
+        """ Converts the attention weights of a checkpoint that predates the fused projections,
+            where the model is saved under prefix. Call after restoring the checkpoint.
+        """
+        reader = tf.train.load_checkpoint(checkpoint_path)
+        suffix = '/mha/dense/kernel/.ATTRIBUTES/VARIABLE_VALUE'
+        for name in reader.get_variable_to_shape_map():
+            if not (name.startswith(f'{prefix}/') and name.endswith(suffix)):
+                continue
+            # e.g. net/decoder/CADB/0/sarn/mha/dense/kernel/.ATTRIBUTES/VARIABLE_VALUE
+            layer = self
+            for attribute in name[len(prefix) + 1:-len(suffix)].split('/'):
+                layer = layer[int(attribute)] if attribute.isdigit() else getattr(layer, attribute)
+            layer.mha.from_legacy_weights(reader, prefix=name[:-len(suffix)] + '/mha',
+                                          fuse_qkv=isinstance(layer, SelfAttentionResNorm))
+    
+    def fold_batch_norms(self):
+        """ Folds the postnet batch normalizations into inference-only copies of its convolutions. """
+        self.decoder_postnet.fold_batch_norms()
+        # retrace, since the traced functions apply the batch normalizations
+        self.__apply_all_signatures()
+    
     def set_constants(self, decoder_prenet_dropout: float = None, learning_rate: float = None,
                       reduction_factor: float = None, drop_n_heads: int = None):
         if decoder_prenet_dropout is not None:
             self.decoder_prenet_dropout = decoder_prenet_dropout
+            self.decoder_prenet.rate.assign(decoder_prenet_dropout)
         if learning_rate is not None:
             self.optimizer.lr.assign(learning_rate)
         if reduction_factor is not None:
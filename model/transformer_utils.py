@@ -21,7 +21,7 @@ def positional_encoding(position, model_dim):
     return tf.cast(pos_encoding, dtype=tf.float32)
 
 
-def scaled_dot_product_attention(q, k, v, mask):
+def scaled_dot_product_attention(q, k, v, mask, additive_mask=False):
     """Calculate the attention weights.
   q, k, v must have matching leading dimensions.
   k, v must have matching penultimate dimension, i.e.: seq_len_k = seq_len_v.
@@ -32,8 +32,10 @@ def scaled_dot_product_attention(q, k, v, mask):
     q: query shape == (..., seq_len_q, depth)
     k: key shape == (..., seq_len_k, depth)
     v: value shape == (..., seq_len_v, depth_v)
-    mask: Float tensor with shape broadcastable
+    mask: Tensor of any numeric dtype with ones at the masked positions and shape broadcastable
           to (..., seq_len_q, seq_len_k). Defaults to None.
+    additive_mask: whether mask is already in additive form (see create_additive_mask),
+          e.g. when it is prepared once for all the layers of a stack.
 
   Returns:
     output, attention_weights
@@ -41,34 +43,90 @@ def scaled_dot_product_attention(q, k, v, mask):
     
     matmul_qk = tf.matmul(q, k, transpose_b=True)  # (..., seq_len_q, seq_len_k)
     
-    # scale matmul_qk
-    dk = tf.cast(tf.shape(k)[-1], tf.float32)
-    scaled_attention_logits = matmul_qk / tf.math.sqrt(dk)
+    # scale matmul_qk (static depth keeps the matmul-scale-mask-softmax-matmul chain fusable by XLA)
+    dk = k.shape[-1]
+    if dk is None:
+        dk = tf.cast(tf.shape(k)[-1], tf.float32)
+    scaled_attention_logits = matmul_qk / tf.math.sqrt(tf.cast(dk, matmul_qk.dtype))
     
     # add the mask to the scaled tensor.
     if mask is not None:
-        scaled_attention_logits += mask * -1e9
+        if not additive_mask:
+            mask = create_additive_mask(mask, scaled_attention_logits.dtype)
+        scaled_attention_logits += mask
     
     # softmax is normalized on the last axis (seq_len_k) so that the scores
-    # add up to 1.
-    attention_weights = tf.nn.softmax(scaled_attention_logits, axis=-1)  # (..., seq_len_q, seq_len_k)
+    # add up to 1. It is computed in float32 for stability under mixed precision.
+    attention_weights = tf.nn.softmax(tf.cast(scaled_attention_logits, tf.float32),
+                                      axis=-1)  # (..., seq_len_q, seq_len_k)
     
-    output = tf.matmul(attention_weights, v)  # (..., seq_len_q, depth_v)
+    output = tf.matmul(tf.cast(attention_weights, v.dtype), v)  # (..., seq_len_q, depth_v)
     
     return output, attention_weights
 
 
+def dropout_residual_layer_norm(x, residual, layer_norm, dropout_rate, training):
+    """Calculate layer_norm(residual + dropout(x)) as one chain of elementwise ops,
+    which XLA fuses into a single kernel when the model is jit compiled.
+    
+  Args:
+    x: sub-layer output shape == (..., model_dim)
+    residual: sub-layer input shape == (..., model_dim)
+    layer_norm: tf.keras.layers.LayerNormalization holding gamma, beta and epsilon.
+    dropout_rate: dropout rate applied to x at training time.
+    training: python bool.
+  
+  Returns:
+    normalized output shape == (..., model_dim)
+  """
+    
+    if not layer_norm.built:
+        layer_norm.build(residual.shape)
+    if training and dropout_rate > 0:
+        x = tf.nn.dropout(x, rate=dropout_rate)
+    x = residual + x
+    # normalize in float32 for numerical stability under mixed precision
+    x_32 = tf.cast(x, tf.float32)
+    mean, variance = tf.nn.moments(x_32, axes=[-1], keepdims=True)
+    normalized = (x_32 - mean) * tf.math.rsqrt(variance + layer_norm.epsilon) * layer_norm.gamma + layer_norm.beta
+    return tf.cast(normalized, x.dtype)
+
+
+def stack_attention_weights(attention_weights: list):
+    """Stack the attention weights of consecutive layers.
+    Layers with fewer heads are padded with all-zero heads.
+    
+  Args:
+    attention_weights: list of tensors with shape (batch_size, num_heads, seq_len_q, seq_len_k)
+  
+  Returns:
+    stacked attention weights shape == (n_layers, batch_size, max(num_heads), seq_len_q, seq_len_k)
+  """
+    
+    max_heads = max(weights.shape[1] for weights in attention_weights)
+    return tf.stack([tf.pad(weights, [[0, 0], [0, max_heads - weights.shape[1]], [0, 0], [0, 0]])
+                     for weights in attention_weights])
+
+
+# masks are int8, a quarter of the size of float32 masks, and are cast by create_additive_mask
+
+
 def create_encoder_padding_mask(seq):
-    seq = tf.cast(tf.math.equal(seq, 0), tf.float32)
+    seq = tf.cast(tf.math.equal(seq, 0), tf.int8)
     return seq[:, tf.newaxis, tf.newaxis, :]  # (batch_size, 1, y, x)
 
 
 def create_mel_padding_mask(seq):
     seq = tf.reduce_sum(tf.math.abs(seq), axis=-1)
-    seq = tf.cast(tf.math.equal(seq, 0), tf.float32)
+    seq = tf.cast(tf.math.equal(seq, 0), tf.int8)
     return seq[:, tf.newaxis, tf.newaxis, :]  # (batch_size, 1, y, x)
 
 
+def create_additive_mask(mask, dtype):
+    """Turn a mask with ones at the masked positions into the form that is added to the attention logits."""
+    return tf.cast(mask, dtype) * -1e9
+
+
 def create_look_ahead_mask(size):
-    mask = 1 - tf.linalg.band_part(tf.ones((size, size)), -1, 0)
+    mask = 1 - tf.linalg.band_part(tf.ones((size, size), dtype=tf.int8), -1, 0)
     return mask
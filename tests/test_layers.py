@@ -0,0 +1,115 @@
+import tempfile
+import unittest
+
+import tensorflow as tf
+
+from model.layers import HeadDrop, MultiHeadAttention, Postnet
+from model.transformer_utils import create_additive_mask, create_look_ahead_mask
+
+
+class TestHeadDrop(unittest.TestCase):
+    
+    def test_tensor_drop_n_heads(self):
+        head_drop = HeadDrop()
+        batch = tf.ones((2, 4, 3, 5))
+        
+        @tf.function
+        def drop(drop_n_heads):
+            return head_drop(batch, training=True, drop_n_heads=drop_n_heads)
+        
+        out = drop(tf.constant(0, tf.int32))
+        self.assertEqual(0., float(tf.reduce_max(tf.abs(out - batch))))
+        
+        out = drop(tf.constant(1, tf.int32))
+        kept_heads = tf.reduce_sum(tf.cast(out[:, :, 0, 0] > 0, tf.int32), axis=1)
+        self.assertEqual([3, 3], kept_heads.numpy().tolist())
+        self.assertAlmostEqual(4 / 3, float(tf.reduce_max(out)), places=5)
+    
+    def test_int_drop_n_heads(self):
+        head_drop = HeadDrop()
+        batch = tf.ones((2, 4, 3, 5))
+        out = head_drop(batch, training=True, drop_n_heads=2)
+        kept_heads = tf.reduce_sum(tf.cast(out[:, :, 0, 0] > 0, tf.int32), axis=1)
+        self.assertEqual([2, 2], kept_heads.numpy().tolist())
+        self.assertAlmostEqual(2., float(tf.reduce_max(out)), places=5)
+
+
+class TestMultiHeadAttention(unittest.TestCase):
+    
+    def test_additive_mask(self):
+        tf.random.set_seed(42)
+        x = tf.random.uniform((2, 5, 16))
+        mha = MultiHeadAttention(16, 2)
+        mask = create_look_ahead_mask(5)
+        expected, expected_weights = mha(x, x, x, mask, training=False, drop_n_heads=0)
+        output, weights = mha(x, x, x, create_additive_mask(mask, x.dtype), training=False, drop_n_heads=0,
+                              additive_mask=True)
+        self.assertLess(float(tf.reduce_max(tf.abs(output - expected))), 1e-6)
+        self.assertLess(float(tf.reduce_max(tf.abs(weights - expected_weights))), 1e-6)
+        self.assertEqual(0., float(tf.reduce_max(weights[:, :, 0, 1:])))
+    
+    def test_legacy_output_projection(self):
+        tf.random.set_seed(42)
+        q_in = tf.random.uniform((2, 5, 16))
+        enc_output = tf.random.uniform((2, 7, 24))
+        mha = MultiHeadAttention(16, 2)
+        expected, _ = mha(enc_output, enc_output, q_in, None, training=False, drop_n_heads=0)
+        # separate projections and unsplit output projection, as in checkpoints that predate the fused ones
+        legacy = tf.Module()
+        legacy.wq, legacy.wk, legacy.wv = mha.wq, mha.wk, mha.wv
+        legacy.dense = tf.keras.layers.Dense(16)
+        legacy.dense.build(tf.TensorShape([None, 32]))
+        legacy.dense.kernel.assign(tf.concat([mha.dense_q.kernel, mha.attention_kernel], axis=0))
+        legacy.dense.bias.assign(mha.attention_bias)
+        with tempfile.TemporaryDirectory() as checkpoint_dir:
+            checkpoint_path = tf.train.Checkpoint(net=legacy).save(f'{checkpoint_dir}/ckpt')
+            restored = MultiHeadAttention(16, 2)
+            tf.train.Checkpoint(net=restored).restore(checkpoint_path)
+            restored.from_legacy_weights(tf.train.load_checkpoint(checkpoint_path), prefix='net', fuse_qkv=False)
+            output, _ = restored(enc_output, enc_output, q_in, None, training=False, drop_n_heads=0)
+        self.assertLess(float(tf.reduce_max(tf.abs(output - expected))), 1e-5)
+
+
+class TestPostnet(unittest.TestCase):
+    
+    @staticmethod
+    def new_postnet(separable_convs):
+        tf.random.set_seed(42)
+        postnet = Postnet(mel_channels=8, conv_filters=16, conv_layers=3, kernel_size=3,
+                          separable_convs=separable_convs)
+        postnet(tf.zeros((1, 1, 8)), training=False)
+        for batch_norm in postnet.postnet_conv_layers.batch_norms:
+            for variable in [batch_norm.gamma, batch_norm.beta, batch_norm.moving_mean]:
+                variable.assign(tf.random.normal(variable.shape))
+            batch_norm.moving_variance.assign(tf.random.uniform(batch_norm.moving_variance.shape, .5, 2.))
+        return postnet
+    
+    def assert_folding_keeps_outputs(self, separable_convs):
+        postnet = self.new_postnet(separable_convs)
+        x = tf.random.uniform((2, 9, 8))
+        expected = postnet(x, training=False)['final_output']
+        postnet.fold_batch_norms()
+        self.assertTrue(any(postnet.postnet_conv_layers.folded_convolutions))
+        output = postnet(x, training=False)['final_output']
+        self.assertLess(float(tf.reduce_max(tf.abs(output - expected))), 1e-5)
+    
+    def test_folding_keeps_weights(self):
+        postnet = self.new_postnet(separable_convs=True)
+        for dropout in postnet.postnet_conv_layers.dropouts:
+            dropout.rate = 0.
+        x = tf.random.uniform((2, 9, 8))
+        expected = postnet(x, training=True)['final_output']
+        weights = postnet.get_weights()
+        postnet.fold_batch_norms()
+        self.assertEqual(len(weights), len(postnet.weights))
+        for weight, folded_weight in zip(weights, postnet.get_weights()):
+            self.assertTrue((weight == folded_weight).all())
+        # training still applies the batch normalizations
+        output = postnet(x, training=True)['final_output']
+        self.assertLess(float(tf.reduce_max(tf.abs(output - expected))), 1e-5)
+    
+    def test_fold_batch_norms(self):
+        self.assert_folding_keeps_outputs(separable_convs=False)
+    
+    def test_fold_batch_norms_separable(self):
+        self.assert_folding_keeps_outputs(separable_convs=True)
@@ -0,0 +1,151 @@
+import tempfile
+import unittest
+
+import numpy as np
+import tensorflow as tf
+
+from model.models import AutoregressiveTransformer
+from utils.config_manager import ConfigManager
+
+
+def new_model(decoder_dense_blocks=2):
+    model = AutoregressiveTransformer(mel_channels=8,
+                                      encoder_model_dimension=32,
+                                      decoder_model_dimension=16,
+                                      encoder_num_heads=[2, 2],
+                                      decoder_num_heads=[2, 2],
+                                      encoder_feed_forward_dimension=24,
+                                      decoder_feed_forward_dimension=24,
+                                      encoder_maximum_position_encoding=100,
+                                      decoder_maximum_position_encoding=200,
+                                      encoder_dense_blocks=1,
+                                      decoder_dense_blocks=decoder_dense_blocks,
+                                      encoder_prenet_dimension=32,
+                                      decoder_prenet_dimension=16,
+                                      postnet_conv_filters=16,
+                                      postnet_conv_layers=3,
+                                      postnet_kernel_size=3,
+                                      dropout_rate=0.1,
+                                      mel_start_value=.5,
+                                      mel_end_value=-.5,
+                                      max_r=2)
+    model._set_r(2)
+    model.decoder_prenet.rate.assign(0.)
+    return model
+
+
+def save_legacy_checkpoint(model, checkpoint_prefix, **roots):
+    """ Saves model as net in the layout of the checkpoints that predate the fused attention projections. """
+    suffix = '/.ATTRIBUTES/VARIABLE_VALUE'
+    with tempfile.TemporaryDirectory() as checkpoint_dir:
+        reader = tf.train.load_checkpoint(tf.train.Checkpoint(net=model).save(f'{checkpoint_dir}/ckpt'))
+        weights = {name[:-len(suffix)]: reader.get_tensor(name) for name in reader.get_variable_to_shape_map()
+                   if name.startswith('net/') and name.endswith(suffix)}
+    legacy_weights = {}
+    for name, value in weights.items():
+        path, variable = name.rsplit('/', 1)
+        if path.endswith('/mha/wqkv'):
+            for projection, weight in zip(['wq', 'wk', 'wv'], np.split(value, 3, axis=-1)):
+                legacy_weights[f'{path[:-len("wqkv")]}{projection}/{variable}'] = weight
+        elif variable == 'attention_kernel':
+            legacy_weights[f'{path}/dense/kernel'] = np.concatenate([weights[f'{path}/dense_q/kernel'], value])
+        elif variable == 'attention_bias':
+            legacy_weights[f'{path}/dense/bias'] = value
+        elif not path.endswith('/mha/dense_q'):
+            legacy_weights[name] = value
+    root = tf.Module()
+    for name, value in legacy_weights.items():
+        node = root
+        *path, variable = name.split('/')
+        for attribute in path:
+            if not hasattr(node, attribute):
+                setattr(node, attribute, tf.Module())
+            node = getattr(node, attribute)
+        setattr(node, variable, tf.Variable(value))
+    return tf.train.Checkpoint(net=root.net, **roots).save(checkpoint_prefix)
+
+
+class TestLegacyWeights(unittest.TestCase):
+    
+    def test_from_legacy_weights(self):
+        tf.random.set_seed(42)
+        inp = tf.constant([[3, 4, 5, 6, 0]], tf.int32)
+        mel = tf.random.uniform((1, 7, 8))
+        model = new_model()
+        expected = model.forward(inp, mel)['final_output']
+        with tempfile.TemporaryDirectory() as checkpoint_dir:
+            checkpoint_path = save_legacy_checkpoint(model, f'{checkpoint_dir}/ckpt')
+            self.assertTrue(ConfigManager.is_legacy_checkpoint(checkpoint_path))
+            
+            # restored into an unbuilt model, as in ConfigManager.load_model
+            restored = new_model()
+            tf.train.Checkpoint(net=restored).restore(checkpoint_path)
+            restored.from_legacy_weights(checkpoint_path)
+            restored.decoder_prenet.rate.assign(0.)
+            output = restored.forward(inp, mel)['final_output']
+        self.assertLess(float(tf.reduce_max(tf.abs(output - expected))), 1e-5)
+    
+    def test_resume_training(self):
+        tf.random.set_seed(42)
+        inp = tf.constant([[3, 4, 5, 6, 0]], tf.int32)
+        mel = tf.random.uniform((1, 7, 8))
+        stop = tf.constant([[1] * 6 + [2]], tf.int32)
+        legacy = new_model()
+        legacy_output = legacy.forward(inp, mel)['final_output']
+        with tempfile.TemporaryDirectory() as checkpoint_dir:
+            save_legacy_checkpoint(legacy, f'{checkpoint_dir}/ckpt', step=tf.Variable(1))
+            
+            # as in train.py
+            model = new_model()
+            model._compile(stop_scaling=8, optimizer=tf.keras.optimizers.Adam(1e-3))
+            checkpoint = tf.train.Checkpoint(step=tf.Variable(1), optimizer=model.optimizer, net=model)
+            manager = tf.train.CheckpointManager(checkpoint, checkpoint_dir, max_to_keep=None)
+            ConfigManager.restore_checkpoint(checkpoint, manager.latest_checkpoint)
+            output = model.forward(inp, mel)['final_output']
+            self.assertLess(float(tf.reduce_max(tf.abs(output - legacy_output))), 1e-5)
+            model.train_step(inp, mel, stop)
+            expected = model.forward(inp, mel)['final_output']
+            checkpoint_path = manager.save()
+            self.assertFalse(ConfigManager.is_legacy_checkpoint(checkpoint_path))
+            
+            # the trained weights are restored, rather than converted from the legacy ones again
+            restored = new_model()
+            ConfigManager.restore_checkpoint(tf.train.Checkpoint(net=restored), checkpoint_path)
+            restored.decoder_prenet.rate.assign(0.)
+            output = restored.forward(inp, mel)['final_output']
+        self.assertLess(float(tf.reduce_max(tf.abs(output - expected))), 1e-5)
+
+
+class TestPredict(unittest.TestCase):
+    
+    def assert_predict_matches_full_decoding(self, decoder_dense_blocks):
+        tf.random.set_seed(42)
+        model = new_model(decoder_dense_blocks=decoder_dense_blocks)
+        # never predict the stop token, to compare all the max_length steps
+        model.decoder_postnet.stop_linear.build(tf.TensorShape([None, 8]))
+        model.decoder_postnet.stop_linear.bias.assign([0., 10., 0.])
+        inp = tf.constant([3, 4, 5, 6, 7], tf.int32)
+        max_length = 20
+        predicted = model.predict(inp, max_length=max_length, encode=False, verbose=False)
+        
+        # decode recomputing all the time steps at each step
+        encoder_output, padding_mask, _ = model.forward_encoder(tf.expand_dims(inp, 0))
+        output = tf.expand_dims(model.start_vec, 0)
+        output_concat = output
+        for i in range(int(max_length // model.r) + 1):
+            model_out = model.forward_decoder(encoder_output, output, padding_mask)
+            output = tf.concat([output, model_out['final_output'][:1, -1:, :]], axis=-2)
+            output_concat = tf.concat([output_concat, model_out['final_output'][:1, -model.r:, :]], axis=-2)
+            if int(tf.argmax(model_out['stop_prob'][:, -1], axis=-1)) == model.stop_prob_index:
+                break
+        
+        self.assertEqual(output_concat.shape[1] - 1, predicted['mel'].shape[0])
+        self.assertLess(float(tf.reduce_max(tf.abs(predicted['mel'] - output_concat[0, 1:]))), 1e-5)
+        self.assertLess(float(tf.reduce_max(tf.abs(predicted['decoder_attention'] -
+                                                   model_out['decoder_attention']))), 1e-5)
+    
+    def test_dense_blocks(self):
+        self.assert_predict_matches_full_decoding(decoder_dense_blocks=2)
+    
+    def test_conv_blocks(self):
+        self.assert_predict_matches_full_decoding(decoder_dense_blocks=1)
@@ -70,6 +70,8 @@ config_manager.create_remove_dirs(clear_dir=args.clear_dir,
                                   clear_weights=args.clear_weights)
 config_manager.dump_config()
 config_manager.print_config()
+if config.get('mixed_precision', False):
+    tf.keras.mixed_precision.set_global_policy('mixed_bfloat16')
 
 train_samples, _ = load_files(metafile=str(config_manager.train_datadir / 'train_metafile.txt'),
                               meldir=str(config_manager.train_datadir / 'mels'),
@@ -105,7 +107,7 @@ checkpoint = tf.train.Checkpoint(step=tf.Variable(1),
 manager = tf.train.CheckpointManager(checkpoint, str(config_manager.weights_dir),
                                      max_to_keep=config['keep_n_weights'],
                                      keep_checkpoint_every_n_hours=config['keep_checkpoint_every_n_hours'])
-checkpoint.restore(manager.latest_checkpoint)
+config_manager.restore_checkpoint(checkpoint, manager.latest_checkpoint)
 if manager.latest_checkpoint:
     print(f'\nresuming training from step {model.step} ({manager.latest_checkpoint})')
 else:
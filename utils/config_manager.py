@@ -102,12 +102,14 @@ class ConfigManager:
                                          postnet_conv_filters=self.config['postnet_conv_filters'],
                                          postnet_conv_layers=self.config['postnet_conv_layers'],
                                          postnet_kernel_size=self.config['postnet_kernel_size'],
+                                         postnet_separable_convs=self.config.get('postnet_separable_convs', False),
                                          dropout_rate=self.config['dropout_rate'],
                                          max_r=self.max_r,
                                          mel_start_value=self.config['mel_start_value'],
                                          mel_end_value=self.config['mel_end_value'],
                                          phoneme_language=self.config['phoneme_language'],
-                                         debug=self.config['debug'])
+                                         debug=self.config['debug'],
+                                         jit_compile=self.config.get('jit_compile', False))
     
     def compile_model(self, model):
         model._compile(stop_scaling=self.stop_scaling, optimizer=self.new_adam(self.learning_rate))
@@ -143,25 +145,38 @@ class ConfigManager:
         self.log_dir.mkdir(exist_ok=True)
         self.weights_dir.mkdir(exist_ok=True)
     
-    def load_model(self, checkpoint_path: str = None, verbose=True):
+    @staticmethod
+    def is_legacy_checkpoint(checkpoint_path: str):
+        """ Whether the checkpoint predates the fused attention projections (see from_legacy_weights). """
+        names = [name for name, _ in tf.train.list_variables(checkpoint_path)]
+        return any('/mha/dense/' in name for name in names) and not any('/mha/dense_q/' in name for name in names)
+    
+    @classmethod
+    def restore_checkpoint(cls, checkpoint: tf.train.Checkpoint, checkpoint_path: str):
+        """ Restores checkpoint, which holds the model as net, converting the weights of legacy checkpoints. """
+        status = checkpoint.restore(checkpoint_path)
+        if checkpoint_path and cls.is_legacy_checkpoint(checkpoint_path):
+            checkpoint.net.from_legacy_weights(checkpoint_path)
+        return status
+    
+    def load_model(self, checkpoint_path: str = None, verbose=True, fold_batch_norms=False):
         model = self.get_model()
         self.compile_model(model)
         ckpt = tf.train.Checkpoint(net=model)
         manager = tf.train.CheckpointManager(ckpt, self.weights_dir,
                                              max_to_keep=None)
-        if checkpoint_path:
-            ckpt.restore(checkpoint_path)
-            if verbose:
-                print(f'restored weights from {checkpoint_path} at step {model.step}')
-        else:
+        if not checkpoint_path:
             if manager.latest_checkpoint is None:
                 print(f'WARNING: could not find weights file. Trying to load from \n {self.weights_dir}.')
                 print('Edit data_config.yaml to point at the right log directory.')
-            ckpt.restore(manager.latest_checkpoint)
-            if verbose:
-                print(f'restored weights from {manager.latest_checkpoint} at step {model.step}')
+            checkpoint_path = manager.latest_checkpoint
+        self.restore_checkpoint(ckpt, checkpoint_path)
+        if verbose:
+            print(f'restored weights from {checkpoint_path} at step {model.step}')
         decoder_prenet_dropout = piecewise_linear_schedule(model.step, self.config['decoder_dropout_schedule'])
         reduction_factor = reduction_schedule(model.step, self.config['reduction_factor_schedule'])
         model.set_constants(decoder_prenet_dropout=decoder_prenet_dropout,
                             reduction_factor=reduction_factor)
+        if fold_batch_norms:
+            model.fold_batch_norms()
         return model
@@ -81,9 +81,14 @@ class SummaryManager:
     
     @ignore_exception
     def display_attention_heads(self, outputs, tag=''):
-        for layer in ['encoder_attention', 'decoder_attention']:
-            for k in outputs[layer].keys():
-                image = tight_grid(norm_tensor(outputs[layer][k][0]))
+        for layer, names in [('encoder_attention', self.model.encoder.attention_names),
+                             ('decoder_attention', self.model.decoder.attention_names),
+                             ('decoder_self_attention', self.model.decoder.self_attention_names)]:
+            if layer not in outputs:  # e.g. predict does not return the decoder self-attention
+                continue
+            # outputs[layer] is stacked along the attention blocks
+            for k, attention_weights in zip(names, outputs[layer]):
+                image = tight_grid(norm_tensor(attention_weights[0]))
                 # dim 0 of image_batch is now number of heads
                 batch_plot_path = f'{tag}/{layer}/{k}'
                 self.add_image(str(batch_plot_path), tf.expand_dims(tf.expand_dims(image, 0), -1))